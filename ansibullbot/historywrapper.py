@@ -1,14 +1,47 @@
+import bisect
 import datetime
 import logging
 import os
 import pickle
-from collections.abc import Sequence
+import pickletools
+import re
+import sys
+from collections import Counter, defaultdict
 from operator import itemgetter
 
 import ansibullbot.constants as C
 from ansibullbot.utils.timetools import strip_time_safely
 
 
+_PICKLE_PROTOCOL = pickle.HIGHEST_PROTOCOL
+
+_BOT_NAMES = frozenset(C.DEFAULT_BOT_NAMES)
+
+# <!--- boilerplate: needs_info --->
+_BOILERPLATE_RE = re.compile(r'boilerplate:[ \t]*(\S+)')
+
+_COMMAND_RE_CACHE = {}
+
+
+def _command_re(command_key):
+    """Compile (once) a pattern matching a line that starts with command_key"""
+    rex = _COMMAND_RE_CACHE.get(command_key)
+    if rex is None:
+        rex = _COMMAND_RE_CACHE[command_key] = re.compile(r'^\s*' + re.escape(command_key), re.MULTILINE)
+    return rex
+
+
+def _normalize_event(event):
+    """Intern the repeated strings of an event and make sure comments have a body"""
+    for key in ('event', 'actor', 'label'):
+        value = event.get(key)
+        if type(value) is str:
+            event[key] = sys.intern(value)
+    if event['event'] == 'commented' or event['event'].startswith('review_'):
+        if event.get('body') is None:
+            event['body'] = ''
+
+
 class HistoryWrapper:
     """A tool to ask questions about an issue's history.
 
@@ -17,7 +50,7 @@ class HistoryWrapper:
     having to iterate through events manually.
     """
 
-    SCHEMA_VERSION = 1.2
+    SCHEMA_VERSION = 1.4
 
     def __init__(self, events, labels, last_updated, usecache=True, cachedir=None):
         self.labels = labels
@@ -25,22 +58,56 @@ class HistoryWrapper:
         self.cachedir = cachedir
 
         self._waffled_labels = None
+        self._by_event = None
+        self._label_dates = None
+        self._lowered_bodies = {}
+        self._boilerplate_cache = {}
         self.cachefile = os.path.join(cachedir, 'history.pickle')
 
+        # sorted() also gives us our own copy of the events list, which
+        # the merge methods below modify in place
         if usecache:
             cache = self._load_cache()
 
             if not self.validate_cache(cache):
                 logging.info('history cache invalidated, rebuilding')
-                self.history = events
+                self.history = sorted(events, key=itemgetter('created_at'))
                 self._dump_cache()
             else:
                 logging.info('use cached history')
+                # the cache is always written sorted
                 self.history = cache['history']
         else:
-            self.history = events
+            self.history = sorted(events, key=itemgetter('created_at'))
 
-        self.history = sorted(self.history, key=itemgetter('created_at'))
+        self._keys = [x['created_at'] for x in self.history]
+        for event in self.history:
+            _normalize_event(event)
+
+    def _insert_event(self, event):
+        """Add an event while keeping the history sorted by date"""
+        _normalize_event(event)
+        idx = bisect.bisect_right(self._keys, event['created_at'])
+        self._keys.insert(idx, event['created_at'])
+        self.history.insert(idx, event)
+
+    def _index(self):
+        """Group the history by event type, rebuilt after each merge"""
+        if self._by_event is None:
+            self._by_event = defaultdict(list)
+            for event in self.history:
+                self._by_event[event['event']].append(event)
+        return self._by_event
+
+    def _label_index(self):
+        """Map (event type, label) to the dates of those label events"""
+        if self._label_dates is None:
+            self._label_dates = defaultdict(list)
+            index = self._index()
+            for eventname in ('labeled', 'unlabeled'):
+                for event in index.get(eventname, []):
+                    self._label_dates[(eventname, event['label'])].append(event['created_at'])
+        return self._label_dates
 
     def validate_cache(self, cache):
         if cache is None:
@@ -84,8 +151,11 @@ class HistoryWrapper:
             logging.info('!%s' % self.cachefile)
             return
         try:
+            # one read and an in-memory unpickle is cheaper than letting
+            # pickle pull many small chunks through the file object
             with open(self.cachefile, 'rb') as f:
-                cachedata = pickle.load(f)
+                data = f.read()
+            cachedata = pickle.loads(data)
         except Exception as e:
             logging.debug(e)
             logging.info('%s failed to load' % self.cachefile)
@@ -94,7 +164,7 @@ class HistoryWrapper:
         return cachedata
 
     def _dump_cache(self):
-        if any(x for x in self.history if not isinstance(x['created_at'], datetime.datetime)):
+        if any(not isinstance(x['created_at'], datetime.datetime) for x in self.history):
             logging.error(self.history)
             raise AssertionError('found a non-datetime created_at in events data')
 
@@ -108,8 +178,11 @@ class HistoryWrapper:
         }
 
         try:
+            # the cache is loaded far more often than it is written, so
+            # spend a little extra time here to strip unused memo opcodes
+            data = pickletools.optimize(pickle.dumps(cachedata, protocol=_PICKLE_PROTOCOL))
             with open(self.cachefile, 'wb') as f:
-                pickle.dump(cachedata, f)
+                f.write(data)
         except Exception as e:
             logging.error(e)
             raise
@@ -125,8 +198,10 @@ class HistoryWrapper:
             event['created_at'] = xc.commit.committer.date.replace(tzinfo=datetime.timezone.utc)
             event['event'] = 'committed'
             event['message'] = xc.commit.message
-            self.history.append(event)
-        self.history = sorted(self.history, key=itemgetter('created_at'))
+            self._insert_event(event)
+        self._by_event = None
+        self._label_dates = None
+        self._boilerplate_cache = {}
 
     def merge_reviews(self, reviews):
         for review in reviews:
@@ -161,22 +236,31 @@ class HistoryWrapper:
                 event['commit_id'] = None
             event['body'] = review.get('body')
 
-            self.history.append(event)
-        self.history = sorted(self.history, key=itemgetter('created_at'))
+            self._insert_event(event)
+        self._by_event = None
+        self._label_dates = None
+        self._boilerplate_cache = {}
 
     def _find_events_by_actor(self, eventname, actor=None, maxcount=1):
-        if actor is not None and not isinstance(actor, Sequence):
-            actor = [actor]
+        if actor is not None:
+            if isinstance(actor, str):
+                actor = frozenset((actor,))
+            else:
+                actor = frozenset(actor)
+
+        if eventname:
+            events = self._index().get(eventname, [])
+        else:
+            events = self.history
 
         matching_events = []
-        for event in self.history:
-            if event['event'] == eventname or not eventname:
-                if actor is None:
-                    matching_events.append(event)
-                elif event['actor'] in actor:
-                    matching_events.append(event)
-                if len(matching_events) == maxcount:
-                    break
+        for event in events:
+            if actor is None:
+                matching_events.append(event)
+            elif event['actor'] in actor:
+                matching_events.append(event)
+            if len(matching_events) == maxcount:
+                break
 
         return matching_events
 
@@ -197,12 +281,22 @@ class HistoryWrapper:
             username,
             maxcount=999
         )
-        comments = [x['body'] for x in matching_events if searchterm in x['body'].lower()]
+        searchterm = searchterm.lower()
+        comments = []
+        for x in matching_events:
+            # keep lowercased bodies on the side rather than in the events
+            # so they don't end up in the cache or the issue meta
+            l_body = self._lowered_bodies.get(x['body'])
+            if l_body is None:
+                l_body = self._lowered_bodies[x['body']] = x['body'].lower()
+            if searchterm in l_body:
+                comments.append(x['body'])
         return comments
 
     def get_commands(self, username, command_keys, timestamps=False, uselabels=True):
         """Given a list of phrase keys, return a list of phrases used"""
         commands = []
+        key_set = frozenset(command_keys)
 
         comments = self._find_events_by_actor(
             'commented',
@@ -222,26 +316,29 @@ class HistoryWrapper:
         events = comments + labels + unlabels
         events = sorted(events, key=itemgetter('created_at'))
         for event in events:
-            if event['actor'] in C.DEFAULT_BOT_NAMES:
+            if event['actor'] in _BOT_NAMES:
                 continue
             if event['event'] == 'commented':
+                if event['body'].startswith('_From @'):
+                    continue
+                tokens = set(event['body'].split())
+                if tokens.isdisjoint(key_set):
+                    continue
+                # walk the keys rather than the matches to keep their order
                 for y in command_keys:
-                    if event['body'].startswith('_From @'):
-                        continue
-                    l_body = event['body'].split()
-                    if y in l_body and not '!' + y in l_body:
+                    if y in tokens and '!' + y not in tokens:
                         if timestamps:
                             commands.append((event['created_at'], y))
                         else:
                             commands.append(y)
             elif event['event'] == 'labeled' and uselabels:
-                if event['label'] in command_keys:
+                if event['label'] in key_set:
                     if timestamps:
                         commands.append((event['created_at'], event['label']))
                     else:
                         commands.append(event['label'])
             elif event['event'] == 'unlabeled' and uselabels:
-                if event['label'] in command_keys:
+                if event['label'] in key_set:
                     if timestamps:
                         commands.append((event['created_at'], '!' + event['label']))
                     else:
@@ -252,19 +349,14 @@ class HistoryWrapper:
     def get_component_commands(self, command_key='!component'):
         """Given a list of phrase keys, return a list of phrases used"""
         commands = []
+        rex = _command_re(command_key)
         events = self._find_events_by_actor('commented', None, maxcount=999)
-        events = [x for x in events if x['actor'] not in C.DEFAULT_BOT_NAMES]
 
         for event in events:
-            if event.get('body'):
-                matched = False
-                lines = event['body'].split('\n')
-                for line in lines:
-                    if line.strip().startswith(command_key):
-                        matched = True
-                        break
-                if matched:
-                    commands.append(event)
+            if event['actor'] in _BOT_NAMES:
+                continue
+            if rex.search(event['body']):
+                commands.append(event)
 
         return commands
 
@@ -282,97 +374,71 @@ class HistoryWrapper:
         """When was this person pinged last in a comment?"""
         if not isinstance(username, list):
             username = [username]
-        username = ['@' + x for x in username]
-        last_notification = None
-        comments = [x for x in self.history if x['event'] == 'commented']
-        for comment in comments:
-            if not comment.get('body'):
-                continue
-            for un in username:
-                if un in comment['body']:
-                    if not last_notification:
-                        last_notification = comment['created_at']
-                    else:
-                        if comment['created_at'] > last_notification:
-                            last_notification = comment['created_at']
-        return last_notification
+        if not username:
+            return None
+        mentions = re.compile('|'.join(re.escape('@' + x) for x in username))
+        for comment in reversed(self._index().get('commented', [])):
+            if mentions.search(comment['body']):
+                return comment['created_at']
+        return None
 
     def last_comment(self, username):
         last_comment = None
-        for event in reversed(self.history):
-            if event['event'] == 'commented':
-                if type(username) == list:
-                    if event['actor'] in username:
-                        last_comment = event['body']
-                elif event['actor'] == username:
+        for event in reversed(self._index().get('commented', [])):
+            if type(username) == list:
+                if event['actor'] in username:
                     last_comment = event['body']
+            elif event['actor'] == username:
+                last_comment = event['body']
             if last_comment:
                 break
         return last_comment
 
     def label_last_applied(self, label):
         """What date was a label last applied?"""
-        last_date = None
-        for event in reversed(self.history):
-            if event['event'] == 'labeled':
-                if event['label'] == label:
-                    last_date = event['created_at']
-                    break
-        return last_date
+        dates = self._label_index().get(('labeled', label))
+        if dates:
+            return dates[-1]
+        return None
 
     def label_last_removed(self, label):
         """What date was a label last removed?"""
-        last_date = None
-        for event in reversed(self.history):
-            if event['event'] == 'unlabeled':
-                if event['label'] == label:
-                    last_date = event['created_at']
-                    break
-        return last_date
+        dates = self._label_index().get(('unlabeled', label))
+        if dates:
+            return dates[-1]
+        return None
 
     def was_labeled(self, label, bots=None):
         """Were labels -ever- applied to this issue?"""
-        labeled = False
-        for event in self.history:
-            if bots:
-                if event['actor'] in bots:
-                    continue
-            if event['event'] == 'labeled':
-                if label and event['label'] == label:
-                    labeled = True
-                    break
-                elif not label:
-                    labeled = True
-                    break
-        return labeled
+        bots = bots or ()
+        for event in self._index().get('labeled', []):
+            if event['actor'] in bots:
+                continue
+            if not label or event['label'] == label:
+                return True
+        return False
 
     def was_unlabeled(self, label, bots=None):
         """Were labels -ever- unapplied from this issue?"""
-        labeled = False
-        for event in self.history:
-            if bots:
-                if event['actor'] in bots:
-                    continue
-            if event['event'] == 'unlabeled':
-                if label and event['label'] == label:
-                    labeled = True
-                    break
-                elif not label:
-                    labeled = True
-                    break
-        return labeled
+        bots = bots or ()
+        for event in self._index().get('unlabeled', []):
+            if event['actor'] in bots:
+                continue
+            if not label or event['label'] == label:
+                return True
+        return False
 
     def get_boilerplate_comments(self, dates=False, content=True):
+        if (dates, content) in self._boilerplate_cache:
+            return self._boilerplate_cache[(dates, content)]
+
         boilerplates = []
-        comments = self._find_events_by_actor('commented', C.DEFAULT_BOT_NAMES, maxcount=999)
+        comments = self._find_events_by_actor('commented', _BOT_NAMES, maxcount=999)
 
         for comment in comments:
-            if not comment.get('body'):
-                continue
-            if 'boilerplate:' in comment['body']:
-                lines = [x for x in comment['body'].split('\n')
-                         if x.strip() and 'boilerplate:' in x]
-                bp = lines[0].split()[2]
+            m = _BOILERPLATE_RE.search(comment['body'])
+            if m:
+                bp = m.group(1)
 
                 if dates or content:
                     bpc = []
@@ -385,6 +451,7 @@ class HistoryWrapper:
                 else:
                     boilerplates.append(bp)
 
+        self._boilerplate_cache[(dates, content)] = boilerplates
         return boilerplates
 
     def get_boilerplate_comments_content(self):
@@ -394,15 +461,16 @@ class HistoryWrapper:
 
     def last_date_for_boilerplate(self, boiler):
         last_date = None
-        bps = self.get_boilerplate_comments(dates=True)
-        for bp in bps:
+        bps = self.get_boilerplate_comments(dates=True, content=False)
+        for bp in reversed(bps):
             if bp[1] == boiler:
                 last_date = bp[0]
+                break
         return last_date
 
     @property
     def last_commit_date(self):
-        events = [x for x in self.history if x['event'] == 'committed']
+        events = self._index().get('committed')
         if events:
             return events[-1]['created_at']
         else:
@@ -428,11 +496,7 @@ class HistoryWrapper:
         """ detect waffling on labels """
         # https://github.com/ansible/ansibullbot/issues/672
         if self._waffled_labels is None:
-            self._waffled_labels = {}
-            history = [x['label'] for x in self.history if 'label' in x]
-            labels = sorted(set(history))
-            for hl in labels:
-                self._waffled_labels[hl] = len([x for x in history if x == hl])
+            self._waffled_labels = Counter(x['label'] for x in self.history if 'label' in x)
 
         if self._waffled_labels.get(label, 0) >= limit:
             return True
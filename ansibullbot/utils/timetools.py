@@ -6,6 +6,13 @@ from ansibullbot._text_compat import to_text
 
 def strip_time_safely(tstring):
     """Try various formats to strip the time from a string"""
+    # fast path for the GitHub API format, e.g. '2021-04-19T15:12:15Z'
+    if len(tstring) == 20 and tstring[10] == 'T' and tstring[-1] == 'Z':
+        try:
+            return datetime.datetime.fromisoformat(tstring[:-1])
+        except ValueError:
+            pass
+
     tsformats = (
         '%Y-%m-%dT%H:%M:%SZ',
         '%Y-%m-%dT%H:%M:%S.%f',
@@ -1,3 +1,5 @@
+import datetime
+
 import pytest
 
 from unittest import TestCase
@@ -31,3 +33,13 @@ class TestTimeStrip(TestCase):
         ts = '2017-06-01T17:54:00ZDSFSDFDFSDFS'
         with pytest.raises(Exception):
             to = strip_time_safely(ts)
+
+    def test_strip_github_format(self):
+        ts = '2021-04-19T15:12:15Z'
+        to = strip_time_safely(ts)
+        assert to == datetime.datetime(2021, 4, 19, 15, 12, 15)
+
+    def test_strip_invalid_github_format(self):
+        ts = '2021-04-19T25:12:15Z'
+        with pytest.raises(Exception):
+            strip_time_safely(ts)
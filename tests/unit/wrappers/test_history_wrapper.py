@@ -1,5 +1,6 @@
 import datetime
 import tempfile
+from types import SimpleNamespace
 
 import pytest
 
@@ -84,3 +85,111 @@ def test_ignore_events_without_dates_on_last_methods():
     res.append(hw.was_unlabeled('needs_info'))
 
     assert not [x for x in res if x is None]
+
+
+def test_merge_commits_updates_event_lookups():
+    events = [
+        {
+            'id': 1,
+            'actor': 'jimi-c',
+            'body': 'unicorns are awesome',
+            'event': 'commented',
+            'created_at': datetime.datetime(2021, 1, 1, tzinfo=datetime.timezone.utc),
+        }
+    ]
+
+    cachedir = tempfile.mkdtemp()
+    hw = HistoryWrapper(events, [], datetime.datetime.utcnow(), cachedir=cachedir, usecache=False)
+
+    assert hw.last_commit_date is None
+
+    committer = SimpleNamespace(login='jimi-c')
+    commit = SimpleNamespace(
+        sha='abc123',
+        committer=committer,
+        commit=SimpleNamespace(
+            message='fix unicorns',
+            committer=SimpleNamespace(date=datetime.datetime(2021, 1, 2)),
+        ),
+    )
+    hw.merge_commits([commit])
+
+    assert hw.last_commit_date == datetime.datetime(2021, 1, 2, tzinfo=datetime.timezone.utc)
+
+
+def test_search_user_comments_ignores_case():
+    events = [
+        {
+            'id': 1,
+            'actor': 'ansibot',
+            'body': 'Please rebase.\n<!--- boilerplate: merge_commit_notify --->',
+            'event': 'commented',
+            'created_at': datetime.datetime.utcnow(),
+        }
+    ]
+
+    cachedir = tempfile.mkdtemp()
+    hw = HistoryWrapper(events, [], datetime.datetime.utcnow(), cachedir=cachedir, usecache=False)
+
+    assert len(hw.search_user_comments('ansibot', 'please rebase')) == 1
+    assert len(hw.search_user_comments('ansibot', 'PLEASE REBASE')) == 1
+    assert len(hw.search_user_comments('jimi-c', 'please rebase')) == 0
+
+
+def test_find_events_by_actor_matches_whole_names():
+    events = [
+        {
+            'id': 1,
+            'actor': 'bot',
+            'body': 'unicorns are awesome',
+            'event': 'commented',
+            'created_at': datetime.datetime.utcnow(),
+        }
+    ]
+
+    cachedir = tempfile.mkdtemp()
+    hw = HistoryWrapper(events, [], datetime.datetime.utcnow(), cachedir=cachedir, usecache=False)
+
+    assert len(hw._find_events_by_actor('commented', 'bot')) == 1
+    assert len(hw._find_events_by_actor('commented', ['ansibot', 'bot'])) == 1
+    assert len(hw._find_events_by_actor('commented', 'ansibot')) == 0
+
+
+def test_cached_history_is_sorted():
+    events = [
+        {
+            'id': idx,
+            'actor': 'jimi-c',
+            'body': 'unicorns are awesome',
+            'event': 'commented',
+            'created_at': datetime.datetime(2021, 1, day, tzinfo=datetime.timezone.utc),
+        }
+        for idx, day in enumerate([3, 1, 2])
+    ]
+    last_updated = datetime.datetime(2021, 1, 3, tzinfo=datetime.timezone.utc)
+
+    cachedir = tempfile.mkdtemp()
+    HistoryWrapper(events, [], last_updated, cachedir=cachedir)
+    hw = HistoryWrapper([], [], last_updated, cachedir=cachedir)
+
+    assert [x['id'] for x in hw.history] == [1, 2, 0]
+
+
+def test_comments_without_body():
+    events = [
+        {
+            'id': 1,
+            'actor': 'jimi-c',
+            'body': None,
+            'event': 'commented',
+            'created_at': datetime.datetime.utcnow(),
+        }
+    ]
+
+    cachedir = tempfile.mkdtemp()
+    hw = HistoryWrapper(events, [], datetime.datetime.utcnow(), cachedir=cachedir, usecache=False)
+
+    assert hw.history[0]['body'] == ''
+    assert hw.get_component_commands() == []
+    assert hw.last_notified('jimi-c') is None
+    assert hw.search_user_comments('jimi-c', 'unicorns') == []